@@ -53,6 +53,38 @@ def repeat_row(a, which_entry, n_repeats):
     return np.repeat(a, repeater_array, axis=0)
 
 
+def log_mean_exp_of_chunks(chunks):
+    """
+    Given an iterable of 2D numpy arrays with the same number of columns,
+    calculate the log of the mean of the exponentials of each of the columns
+    across all of the rows of all of the chunks.
+
+    This is logsumexp(np.concatenate(chunks), axis=0) - np.log(n_rows), but
+    keeps only a running maximum and a running sum of exponentials per column,
+    so memory doesn't scale with the total number of rows.
+    """
+    log_max = shift = sum_exp = None
+    n_rows = 0
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if log_max is None:
+            log_max = np.full(chunk.shape[1], -np.inf)
+            shift = np.zeros(chunk.shape[1])
+            sum_exp = np.zeros(chunk.shape[1])
+        log_max = np.maximum(log_max, chunk.max(axis=0))
+        # Like logsumexp, we don't shift columns that have no finite maximum.
+        new_shift = np.where(np.isfinite(log_max), log_max, 0.)
+        # Columns with nothing summed yet don't need rescaling, and rescaling
+        # them from the initial shift of zero could give 0 * inf.
+        rescale = np.exp(np.where(sum_exp > 0, shift - new_shift, 0.))
+        sum_exp = sum_exp * rescale + np.exp(chunk - new_shift).sum(axis=0)
+        shift = new_shift
+        n_rows += len(chunk)
+    # A column that is entirely -inf has a sum of zero, and its result is -inf.
+    with np.errstate(divide='ignore'):
+        return shift + np.log(sum_exp) - np.log(n_rows)
+
+
 def logspace(start, stop, num, decimals=3):
     """
     num evenly spaced numbers between start and stop, rounded to the given number of decimals.
@@ -121,6 +121,18 @@ class CDR3Length(Layer):
         return tuple(input_shape[:-2] + tuple([1]))
 
 
+def log_softmax_of_idx(logits, idx):
+    """
+    Given a tensor of logits of shape (batch_size, n_sites, n_states) and an
+    integer tensor of shape (batch_size, n_sites) indexing states, sum the log
+    softmax probabilities of the indexed states across sites.
+    """
+    # Gather the indexed logit at every site, so that we never build a one-hot
+    # (or full log softmax) tensor of the shape of logits.
+    indexed_logits = tf.batch_gather(logits, K.expand_dims(idx, -1))[..., 0]
+    return K.sum(indexed_logits - K.logsumexp(logits, axis=-1), axis=-1)
+
+
 def cumprod_sum(a, length, reverse=False):
     """
     Given a matrix a, take sum_{j=0}^{length-1} prod_{i=0}^j a_{,i} in TensorFlow.
@@ -185,3 +197,34 @@ class ContiguousMatch(Layer):
         assert input_shape[1] == input_shape[2]
         # We just return two numbers for every input.
         return tuple(input_shape[0][:-2] + tuple([2]))
+
+
+class ObservedLogProb(Layer):
+    """
+    A layer that takes in the decoder logits for the CDR3 amino acids and the V
+    and J genes, along with the indices of the observed amino acids and genes,
+    and spits out log p(x|z): the log probability of the observations, one
+    number per input.
+
+    Working from the logits with a log softmax means that we never have to
+    materialize the decoded probability arrays.
+    """
+
+    def __init__(self, **kwargs):
+        super(ObservedLogProb, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        super(ObservedLogProb, self).build(input_shape)  # Be sure to call this at the end
+
+    def call(self, inputs):
+        # The amino acid indices are of shape (batch_size, max_cdr3_len) and
+        # the gene indices are of shape (batch_size, 1).
+        (cdr3_logits, v_gene_logits, j_gene_logits, aa_idx, v_gene_idx, j_gene_idx) = inputs
+        # We give the genes a site axis of length one so that they look like the amino acids.
+        return log_softmax_of_idx(cdr3_logits, aa_idx) + \
+            log_softmax_of_idx(K.expand_dims(v_gene_logits, 1), v_gene_idx) + \
+            log_softmax_of_idx(K.expand_dims(j_gene_logits, 1), j_gene_idx)
+
+    def compute_output_shape(self, input_shape):
+        # We just return one number for every input.
+        return tuple(input_shape[0][:1])
@@ -9,12 +9,12 @@ import numpy as np
 
 import keras
 from keras.models import Model
-from keras.layers import Activation, Dense, Lambda, Input, Reshape
+from keras.layers import Activation, Concatenate, Dense, Flatten, Lambda, Input, Reshape
 from keras import backend as K
 from keras import objectives
 
 import vampire.common as common
-from vampire.custom_keras import BetaWarmup, EmbedViaMatrix
+from vampire.custom_keras import BetaWarmup, EmbedViaMatrix, ObservedLogProb
 
 
 def build(params):
@@ -44,25 +44,42 @@ def build(params):
         return (xent_loss + kl_loss)
 
     # Input:
+    # The VAE is only ever fit and evaluated on full batches (see
+    # TCRVAE.get_data), so we give its inputs a static batch size. The encoder
+    # gets inputs of its own so that it can encode any number of sequences.
     cdr3_input_shape = (params['max_cdr3_len'], params['n_aas'])
-    cdr3_input = Input(shape=cdr3_input_shape, name='cdr3_input')
-    v_gene_input = Input(shape=(params['n_v_genes'], ), name='v_gene_input')
-    j_gene_input = Input(shape=(params['n_j_genes'], ), name='j_gene_input')
+    v_gene_input_shape = (params['n_v_genes'], )
+    j_gene_input_shape = (params['n_j_genes'], )
+    batch_shape_prefix = (params['batch_size'], )
+    cdr3_input = Input(batch_shape=batch_shape_prefix + cdr3_input_shape, name='cdr3_input')
+    v_gene_input = Input(batch_shape=batch_shape_prefix + v_gene_input_shape, name='v_gene_input')
+    j_gene_input = Input(batch_shape=batch_shape_prefix + j_gene_input_shape, name='j_gene_input')
+    encoder_inputs = [Input(shape=shape) for shape in [cdr3_input_shape, v_gene_input_shape, j_gene_input_shape]]
 
     # Encoding layers:
-    cdr3_embedding = EmbedViaMatrix(params['aa_embedding_dim'], name='cdr3_embedding')(cdr3_input)
-    cdr3_embedding_flat = Reshape([params['aa_embedding_dim'] * params['max_cdr3_len']],
-                                  name='cdr3_embedding_flat')(cdr3_embedding)
-    v_gene_embedding = Dense(params['v_gene_embedding_dim'], name='v_gene_embedding')(v_gene_input)
-    j_gene_embedding = Dense(params['j_gene_embedding_dim'], name='j_gene_embedding')(j_gene_input)
-    merged_embedding = keras.layers.concatenate([cdr3_embedding_flat, v_gene_embedding, j_gene_embedding],
-                                                name='merged_embedding')
-    encoder_dense_1 = Dense(params['dense_nodes'], activation='elu', name='encoder_dense_1')(merged_embedding)
-    encoder_dense_2 = Dense(params['dense_nodes'], activation='elu', name='encoder_dense_2')(encoder_dense_1)
+    cdr3_embedding_l = EmbedViaMatrix(params['aa_embedding_dim'], name='cdr3_embedding')
+    cdr3_embedding_flat_l = Flatten(name='cdr3_embedding_flat')
+    v_gene_embedding_l = Dense(params['v_gene_embedding_dim'], name='v_gene_embedding')
+    j_gene_embedding_l = Dense(params['j_gene_embedding_dim'], name='j_gene_embedding')
+    merged_embedding_l = Concatenate(name='merged_embedding')
+    encoder_dense_1_l = Dense(params['dense_nodes'], activation='elu', name='encoder_dense_1')
+    encoder_dense_2_l = Dense(params['dense_nodes'], activation='elu', name='encoder_dense_2')
 
     # Latent layers:
-    z_mean = Dense(params['latent_dim'], name='z_mean')(encoder_dense_2)
-    z_log_var = Dense(params['latent_dim'], name='z_log_var')(encoder_dense_2)
+    z_mean_l = Dense(params['latent_dim'], name='z_mean')
+    z_log_var_l = Dense(params['latent_dim'], name='z_log_var')
+
+    def encode(cdr3, v_gene, j_gene):
+        """
+        Apply the encoding and latent layers, returning z_mean and z_log_var.
+        """
+        merged_embedding = merged_embedding_l(
+            [cdr3_embedding_flat_l(cdr3_embedding_l(cdr3)), v_gene_embedding_l(v_gene), j_gene_embedding_l(j_gene)])
+        encoder_dense_2 = encoder_dense_2_l(encoder_dense_1_l(merged_embedding))
+        return z_mean_l(encoder_dense_2), z_log_var_l(encoder_dense_2)
+
+    z_mean, z_log_var = encode(cdr3_input, v_gene_input, j_gene_input)
+    encoder_z_mean, encoder_z_log_var = encode(*encoder_inputs)
 
     # Decoding layers:
     z_l = Lambda(sampling, output_shape=(params['latent_dim'], ), name='z')
@@ -71,23 +88,35 @@ def build(params):
     cdr3_post_dense_flat_l = Dense(np.array(cdr3_input_shape).prod(), activation='linear', name='cdr3_post_dense_flat')
     cdr3_post_dense_reshape_l = Reshape(cdr3_input_shape, name='cdr3_post_dense')
     cdr3_output_l = Activation(activation='softmax', name='cdr3_output')
-    v_gene_output_l = Dense(params['n_v_genes'], activation='softmax', name='v_gene_output')
-    j_gene_output_l = Dense(params['n_j_genes'], activation='softmax', name='j_gene_output')
+    # We keep the gene logits separate from their softmax so that log_p_x_given_z can use them.
+    v_gene_logits_l = Dense(params['n_v_genes'], activation='linear', name='v_gene_logits')
+    j_gene_logits_l = Dense(params['n_j_genes'], activation='linear', name='j_gene_logits')
+    v_gene_output_l = Activation(activation='softmax', name='v_gene_output')
+    j_gene_output_l = Activation(activation='softmax', name='j_gene_output')
 
     post_decoder = decoder_dense_2_l(decoder_dense_1_l(z_l([z_mean, z_log_var])))
     cdr3_output = cdr3_output_l(cdr3_post_dense_reshape_l(cdr3_post_dense_flat_l(post_decoder)))
-    v_gene_output = v_gene_output_l(post_decoder)
-    j_gene_output = j_gene_output_l(post_decoder)
+    v_gene_output = v_gene_output_l(v_gene_logits_l(post_decoder))
+    j_gene_output = j_gene_output_l(j_gene_logits_l(post_decoder))
 
     # Define the decoder components separately so we can have it as its own model.
     z_mean_input = Input(shape=(params['latent_dim'], ))
     decoder_post_decoder = decoder_dense_2_l(decoder_dense_1_l(z_mean_input))
-    decoder_cdr3_output = cdr3_output_l(cdr3_post_dense_reshape_l(cdr3_post_dense_flat_l(decoder_post_decoder)))
-    decoder_v_gene_output = v_gene_output_l(decoder_post_decoder)
-    decoder_j_gene_output = j_gene_output_l(decoder_post_decoder)
-
-    encoder = Model([cdr3_input, v_gene_input, j_gene_input], [z_mean, z_log_var])
+    decoder_cdr3_logits = cdr3_post_dense_reshape_l(cdr3_post_dense_flat_l(decoder_post_decoder))
+    decoder_cdr3_output = cdr3_output_l(decoder_cdr3_logits)
+    decoder_v_gene_logits = v_gene_logits_l(decoder_post_decoder)
+    decoder_j_gene_logits = j_gene_logits_l(decoder_post_decoder)
+    decoder_v_gene_output = v_gene_output_l(decoder_v_gene_logits)
+    decoder_j_gene_output = j_gene_output_l(decoder_j_gene_logits)
+
+    # log p(x|z) takes the observations as indices (see TCRVAE.get_indices).
+    idx_inputs = [Input(shape=shape, dtype='int32') for shape in [(params['max_cdr3_len'], ), (1, ), (1, )]]
+    log_p_x_given_z_output = ObservedLogProb(name='log_p_x_given_z')(
+        [decoder_cdr3_logits, decoder_v_gene_logits, decoder_j_gene_logits] + idx_inputs)
+
+    encoder = Model(encoder_inputs, [encoder_z_mean, encoder_z_log_var])
     decoder = Model(z_mean_input, [decoder_cdr3_output, decoder_v_gene_output, decoder_j_gene_output])
+    log_p_x_given_z = Model([z_mean_input] + idx_inputs, log_p_x_given_z_output)
     vae = Model([cdr3_input, v_gene_input, j_gene_input], [cdr3_output, v_gene_output, j_gene_output])
     vae.compile(
         optimizer="adam",
@@ -108,7 +137,13 @@ def build(params):
 
     callbacks = [BetaWarmup(beta, params['beta'], params['warmup_period'])]
 
-    return {'encoder': encoder, 'decoder': decoder, 'vae': vae, 'callbacks': callbacks}
+    return {
+        'encoder': encoder,
+        'decoder': decoder,
+        'vae': vae,
+        'log_p_x_given_z': log_p_x_given_z,
+        'callbacks': callbacks
+    }
 
 
 def prepare_data(x_df):
@@ -3,7 +3,10 @@ This file contains the object and CLI for training our VAEs.
 
 The models themselves are in the `models/` directory. Each of these Python
 files should have a `build` function that returns a dictionary with
-entries for: encoder, decoder, and vae.
+entries for: encoder, decoder, vae, and log_p_x_given_z. This last is a model
+that takes z and the indices of observed amino acids and V/J genes (see
+TCRVAE.get_indices) and gives the log probability of those observations given
+z.
 
 We also require each model to define a corresponding `prepare_data` function
 that prepares data for input into the vae, and a `interpret_output` function
@@ -29,28 +32,80 @@ import keras.backend as K
 from keras.callbacks import EarlyStopping, ModelCheckpoint
 
 import scipy.special as special
-import scipy.stats as stats
+import tensorflow as tf
 
 import vampire.common as common
 import vampire.tcregex as tcregex
 import vampire.xcr_vector_conversion as conversion
 
+# The maximum number of rows we push through a model in one go.
+PREDICT_CHUNK_SIZE = 10000
 
-def logprob_of_obs_vect(probs, obs):
+# log(sqrt(2 pi)), the normalizing constant of the standard normal log PDF.
+HALF_LOG_2PI = 0.5 * math.log(2 * math.pi)
+
+
+def norm_logpdf_sum(x, mu, sd):
+    """
+    Calculate the log PDF of a multivariate normal with diagonal covariance,
+    one value per row of x.
+
+    Here we use that the PDF of a multivariate normal with diagonal covariance
+    is the product of the PDF of the individual normal distributions, so the
+    log PDF is a sum across columns.
+
+    :param x: a matrix with each row a point at which to evaluate the PDF.
+    :param mu: a matrix of means, of the same shape as x.
+    :param sd: a matrix of standard deviations, of the same shape as x.
     """
-    Calculate the log of probability of the observations.
+    d = (x - mu) / sd
+    return -0.5 * np.einsum('ij,ij->i', d, d) - np.log(sd).sum(axis=1) - x.shape[1] * HALF_LOG_2PI
 
-    :param probs: a matrix with each row giving the probability of
-        observations.
-    :param obs: a matrix with each row one-hot-encoding an observation.
 
-    Kristian implemented this as
-        np.sum(np.log(np.matmul(probs, obs.T).diagonal()))
-    which is equivalent but harder to follow.
+def predict_in_chunks(model, x, chunk_size=None):
+    """
+    Apply a Keras model to x like Model.predict, but by calling
+    predict_on_batch on chunks of chunk_size rows. This skips the batching
+    machinery of predict (whose default batch size is only 32).
+
+    :param x: A numpy array, or a list of them for a multiple-input model.
+    :param chunk_size: The number of rows per chunk; PREDICT_CHUNK_SIZE if
+        None.
+
+    :return: The model output: a numpy array, or a list of them for a
+        multiple-output model.
+    """
+    if chunk_size is None:
+        chunk_size = PREDICT_CHUNK_SIZE
+    xs = x if isinstance(x, list) else [x]
+    chunk_outputs = [
+        model.predict_on_batch([a[start:start + chunk_size] for a in xs])
+        for start in range(0, len(xs[0]), chunk_size)
+    ]
+    if len(chunk_outputs) == 1:
+        return chunk_outputs[0]
+    if len(model.outputs) == 1:
+        return np.concatenate(chunk_outputs)
+    return [np.concatenate(outputs) for outputs in zip(*chunk_outputs)]
+
+
+def enable_xla_jit():
     """
-    # Here axis=1 means sum across columns (the sum will be empty except for
-    # the single nonzero entry).
-    return np.sum(np.log(np.sum(probs * obs, axis=1)))
+    Have TensorFlow just-in-time compile our models with XLA, which fuses their
+    many small ops (dense layers, softmaxes, the KL terms) into fewer kernels.
+
+    This replaces the Keras session, so call it before building any TCRVAEs.
+    XLA auto-clustering is experimental in TensorFlow 1 and changes the
+    numerical path, so it is opt-in: the CLI only calls this given --xla, and
+    TCRVAEs used as a library don't get it unless this is called explicitly.
+
+    The session-level JIT setting only auto-clusters GPU ops, so this does
+    nothing on CPU. There, XLA needs TF_XLA_FLAGS=--tf_xla_cpu_global_jit set
+    in the environment before TensorFlow starts.
+    """
+    config = tf.ConfigProto()
+    config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    K.set_session(tf.Session(config=config))
 
 
 class TCRVAE:
@@ -151,6 +206,21 @@ class TCRVAE:
             sub_df = df[:n_to_take]
         return conversion.unpadded_tcrbs_to_onehot(sub_df, self.params['max_cdr3_len'])
 
+    def get_indices(self, data):
+        """
+        Get the indices of the observed amino acids and V and J genes, given
+        data that has been through prepare_data. This is all we need to know
+        about the observations to calculate their probabilities: one small
+        integer per site rather than a one-hot vector.
+
+        :param data: The output of prepare_data for some input sequences.
+
+        :return: int32 arrays of shape (n, max_cdr3_len), (n, 1) and (n, 1)
+            respectively, as the log_p_x_given_z model expects.
+        """
+        # We use interpret_output to cut down to what we care about.
+        return [obs.argmax(axis=-1).astype(np.int32).reshape(len(obs), -1) for obs in self.interpret_output(data)]
+
     def fit(self, x_df: pd.DataFrame, validation_split: float, best_weights_fname: str, tensorboard_log_dir: str):
         """
         Fit the vae with warmup and early stopping.
@@ -238,7 +308,19 @@ class TCRVAE:
 
         :return: z_mean and z_sd, the embedding mean and standard deviation.
         """
-        z_mean, z_log_var = self.encoder.predict(self.prepare_data(x_df))
+        return self.encode_data(self.prepare_data(x_df))
+
+    def encode_data(self, data):
+        """
+        Get the VAE encoding of data that has already been through
+        prepare_data, so that callers that need the prepared arrays anyhow
+        don't have to stack them out of the dataframe again.
+
+        :param data: The output of prepare_data for some input sequences.
+
+        :return: z_mean and z_sd, the embedding mean and standard deviation.
+        """
+        z_mean, z_log_var = predict_in_chunks(self.encoder, data)
         z_sd = np.sqrt(np.exp(z_log_var))
         return z_mean, z_sd
 
@@ -246,24 +328,31 @@ class TCRVAE:
         """
         Get the decoding of z.
         """
-        return self.interpret_output(self.decoder.predict(z))
+        return self.interpret_output(predict_in_chunks(self.decoder, z))
 
     def generate(self, n_seqs):
         """
         Generate a data frame of n_seqs sequences.
         """
-        batch_size = self.params['batch_size']
-        # Increase the number of desired sequences as needed so it's divisible by batch_size.
-        n_actual = batch_size * math.ceil(n_seqs / batch_size)
-        # Sample from the latent space to generate sequences:
-        z_sample = np.random.normal(0, 1, size=(n_actual, self.params['latent_dim']))
-        amino_acid_arr, v_gene_arr, j_gene_arr = self.decode(z_sample)
-        # Convert back, restricting to the desired number of sequences.
-        return conversion.onehot_to_tcrbs(amino_acid_arr[:n_seqs], v_gene_arr[:n_seqs], j_gene_arr[:n_seqs])
-
-    def log_pvae_importance_sample(self, x_df, out_ps):
+        # Sample from the latent space to generate sequences. The decoder
+        # takes any number of rows, so we sample exactly n_seqs, in float32
+        # like the decoder. We go a chunk at a time so that the decoded one-hot
+        # arrays stay bounded in size however many sequences we are asked for.
+        rng = np.random.default_rng()
+        chunks = []
+        for start in range(0, n_seqs, PREDICT_CHUNK_SIZE):
+            n_rows = min(PREDICT_CHUNK_SIZE, n_seqs - start)
+            z_sample = rng.standard_normal((n_rows, self.params['latent_dim']), dtype=np.float32)
+            amino_acid_arr, v_gene_arr, j_gene_arr = self.decode(z_sample)
+            # Convert back.
+            chunks.append(conversion.onehot_to_tcrbs(amino_acid_arr, v_gene_arr, j_gene_arr))
+        if len(chunks) == 1:
+            return chunks[0]
+        return pd.concat(chunks, ignore_index=True)
+
+    def log_pvae_importance_samples(self, x_df, nsamples, seed=None):
         """
-        One importance sample to calculate the probability of generating some
+        Importance samples to calculate the probability of generating some
         observed x's by decoding from the prior on z.
 
         Say we just have one x. We want p(x), which in principle we could
@@ -276,63 +365,79 @@ class TCRVAE:
         over z drawn from q(z|x). The ratio in parentheses is the importance
         weight.
 
-        We emphasize that this is _one_ importance sample. Run this lots and
-        take the average to get a good estimate.
+        We encode the x's once, then stack as many importance samples as fit
+        in PREDICT_CHUNK_SIZE rows and decode them in one shot. Take the
+        average of all of the samples to get a good estimate.
 
         The VAE is allowed to have features besides the input of CDR3 amino
         acids and V/J genes. We have to have those be deterministically
         computed from the input, otherwise the methods below won't work.
 
-        Stupid notes:
-        * We could save time by only computing the encoding and the _obs
-        variables once.
-        * Perhaps there is some way to avoid looping like this?
-
         :param x_df: A onehot encoded dataframe representing input sequences.
-        :param out_ps: An np array in which to store the importance sampled ps.
+        :param nsamples: The number of importance samples to take.
+        :param seed: A seed for the random number generator, if we want
+            reproducible samples.
+
+        :return: A generator of float32 arrays of shape (k, len(x_df)), each
+            row of which is one importance sample of log p(x) for every input
+            sequence. The k's sum to nsamples. See common.log_mean_exp_of_chunks
+            for averaging these, which it does in float64.
         """
+        n_seqs = len(x_df)
+        samples_per_chunk = max(1, PREDICT_CHUNK_SIZE // n_seqs)
 
-        # We're going to be getting a one-sample estimate, so we want one slot
-        # in our output array for each input sequence.
-        assert (len(x_df) == len(out_ps))
+        def tile(a):
+            """
+            Stack samples_per_chunk copies of a along the first axis.
+            """
+            return np.tile(a, (samples_per_chunk, ) + (1, ) * (a.ndim - 1))
 
+        # Stack the data columns once; they are used for both the encoding
+        # and the observations.
+        data = self.prepare_data(x_df)
         # Get encoding of x's in the latent space.
-        z_mean, z_sd = self.encode(x_df)
-        # Get samples from q(z|x) in the latent space, one for each input x.
-        z_sample = stats.norm.rvs(z_mean, z_sd)
-        # These are decoded samples from z. They are, thus, probability vectors
-        # that get sampled if we want to realize actual sequences.
-        aa_probs, v_gene_probs, j_gene_probs = self.decode(z_sample)
-
-        # Onehot-encoded observations.
-        # We use interpret_output to cut down to what we care about.
-        aa_obs, v_gene_obs, j_gene_obs = self.interpret_output(self.prepare_data(x_df))
-
-        # Loop over observations.
-        for i in range(len(x_df)):
-            log_p_x_given_z = \
-                logprob_of_obs_vect(aa_probs[i], aa_obs[i]) + \
-                np.log(np.sum(v_gene_probs[i] * v_gene_obs[i])) + \
-                np.log(np.sum(j_gene_probs[i] * j_gene_obs[i]))
-            # p(z)
-            # Here we use that the PDF of a multivariate normal with
-            # diagonal covariance is the product of the PDF of the
-            # individual normal distributions.
-            log_p_z = np.sum(stats.norm.logpdf(z_sample[i], 0, 1))
+        # We work in float32 like the model does: we are estimating an
+        # expectation, so there is no need to double the memory traffic.
+        z_mean, z_sd = [a.astype(np.float32, copy=False) for a in self.encode_data(data)]
+        z_mean_tiled, z_sd_tiled = tile(z_mean), tile(z_sd)
+        latent_dim = z_mean.shape[1]
+        # Indices of the onehot-encoded observations, which don't change
+        # across importance samples.
+        obs_idxs = [tile(idx) for idx in self.get_indices(data)]
+
+        # One generator for the whole run, drawing each chunk's noise in a
+        # single call.
+        rng = np.random.default_rng(seed)
+
+        for chunk_start in range(0, nsamples, samples_per_chunk):
+            n_samples_in_chunk = min(samples_per_chunk, nsamples - chunk_start)
+            n_rows = n_samples_in_chunk * n_seqs
+            # Get samples from q(z|x) in the latent space, n_samples_in_chunk
+            # for each input x.
+            noise = rng.standard_normal((n_rows, latent_dim), dtype=np.float32)
+            z_sample = z_mean_tiled[:n_rows] + z_sd_tiled[:n_rows] * noise
+            # p(x|z), where the decoded samples from z are the probability
+            # vectors that get sampled if we want to realize actual sequences.
+            log_p_x_given_z = predict_in_chunks(self.log_p_x_given_z, [z_sample] + [idx[:n_rows] for idx in obs_idxs])
+            # p(z), which is norm_logpdf_sum with mu=0 and sd=1.
+            log_p_z = -0.5 * np.einsum('ij,ij->i', z_sample, z_sample) - latent_dim * HALF_LOG_2PI
             # q(z|x)
-            log_q_z_given_x = np.sum(stats.norm.logpdf(z_sample[i], z_mean[i], z_sd[i]))
+            log_q_z_given_x = norm_logpdf_sum(z_sample, z_mean_tiled[:n_rows], z_sd_tiled[:n_rows])
             # Importance weight: p(z)/q(z|x)
             log_imp_weight = log_p_z - log_q_z_given_x
             # p(x|z) p(z) / q(z|x)
-            out_ps[i] = log_p_x_given_z + log_imp_weight
+            yield (log_p_x_given_z + log_imp_weight).reshape(n_samples_in_chunk, n_seqs)
 
 
 # ### CLI ###
 
 
 @click.group()
-def cli():
-    pass
+@click.option(
+    '--xla/--no-xla', default=False, show_default=True, help="Compile models with XLA (experimental, GPU only).")
+def cli(xla):
+    if xla:
+        enable_xla_jit()
 
 
 @cli.command()
@@ -439,15 +544,18 @@ def pvae(limit_input_to, nsamples, params_json, model_weights, test_csv, out_csv
     if limit_input_to is not None:
         df_x = df_x.iloc[:int(limit_input_to)]
 
-    log_p_x = np.zeros((nsamples, len(df_x)))
     click.echo("Calculating pvae for {} via importance sampling...".format(test_csv.name))
 
-    with click.progressbar(range(nsamples)) as bar:
-        for i in bar:
-            v.log_pvae_importance_sample(df_x, log_p_x[i])
+    with click.progressbar(length=nsamples) as bar:
+
+        def log_p_x_chunks():
+            for log_p_x_chunk in v.log_pvae_importance_samples(df_x, nsamples):
+                bar.update(len(log_p_x_chunk))
+                yield log_p_x_chunk
+
+        # Calculate log of mean of numbers given in log space.
+        avg = common.log_mean_exp_of_chunks(log_p_x_chunks())
 
-    # Calculate log of mean of numbers given in log space.
-    avg = special.logsumexp(log_p_x, axis=0) - np.log(nsamples)
     pd.DataFrame({'log_p_x': avg}).to_csv(out_csv, index=False)
 
 
@@ -486,14 +594,9 @@ def tcregex_pvae(nsamples, batch_size, max_iters, track_last, tol, params_json,
         df_generated = tcregex.sample_tcregex(in_tcregex, batch_size)
         df_x = conversion.unpadded_tcrbs_to_onehot(df_generated, v.params['max_cdr3_len'])
 
-        log_p_x = np.zeros((nsamples, len(df_x)))
-
-        for i in range(nsamples):
-            v.log_pvae_importance_sample(df_x, log_p_x[i])
-
         # Calculate log of mean of numbers given in log space.
         # This calculates the per-sequence log_p_x estimate.
-        df_generated['log_p_x'] = special.logsumexp(log_p_x, axis=0) - np.log(nsamples)
+        df_generated['log_p_x'] = common.log_mean_exp_of_chunks(v.log_pvae_importance_samples(df_x, nsamples))
         generated_dfs.append(df_generated)
         catted = pd.concat(generated_dfs)
         means.append(special.logsumexp(catted['log_p_x'], axis=0) - np.log(len(catted)))
@@ -0,0 +1,19 @@
+import numpy as np
+import scipy.special as special
+
+import vampire.common as common
+
+
+def test_log_mean_exp_of_chunks():
+    x = np.random.default_rng(0).normal(-100, 20, size=(50, 7))
+    # Make sure we can handle columns that are entirely -inf, as logsumexp does.
+    x[:, 3] = -np.inf
+    # Values below -709 underflow exp, so they need shifting from the start.
+    x[:, 4] -= 1000
+    # A column that starts out -inf and later has very negative values.
+    x[:10, 5] = -np.inf
+    x[10:, 5] = -800
+    correct = special.logsumexp(x, axis=0) - np.log(len(x))
+    for chunk_size in [1, 7, 50]:
+        chunks = [x[i:i + chunk_size] for i in range(0, len(x), chunk_size)]
+        assert np.allclose(common.log_mean_exp_of_chunks(chunks), correct)
@@ -0,0 +1,29 @@
+import numpy as np
+import tensorflow as tf
+
+import vampire.custom_keras as custom_keras
+
+
+def test_observed_log_prob():
+    rng = np.random.default_rng(0)
+    n, max_cdr3_len, n_aas, n_v_genes, n_j_genes = 4, 5, 3, 6, 2
+    logits = [
+        rng.standard_normal(shape).astype(np.float32)
+        for shape in [(n, max_cdr3_len, n_aas), (n, n_v_genes), (n, n_j_genes)]
+    ]
+    idxs = [
+        rng.integers(0, n_aas, (n, max_cdr3_len)),
+        rng.integers(0, n_v_genes, (n, 1)),
+        rng.integers(0, n_j_genes, (n, 1)),
+    ]
+
+    def np_log_prob_of_idx(logits, idx):
+        log_probs = np.log(np.exp(logits) / np.exp(logits).sum(axis=-1, keepdims=True))
+        # Give the genes a site axis to match the amino acids.
+        log_probs = log_probs.reshape(n, -1, logits.shape[-1])
+        return np.take_along_axis(log_probs, idx[..., np.newaxis], axis=-1).sum(axis=(1, 2))
+
+    with tf.Session() as sess:
+        tf_inputs = [tf.constant(a) for a in logits] + [tf.constant(idx, dtype=tf.int32) for idx in idxs]
+        tf_result = sess.run(custom_keras.ObservedLogProb().call(tf_inputs))
+    assert np.allclose(sum(np_log_prob_of_idx(a, idx) for a, idx in zip(logits, idxs)), tf_result, rtol=1e-5)
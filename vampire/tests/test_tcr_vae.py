@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.stats as stats
+
+import vampire.tcr_vae as tcr_vae
+import vampire.xcr_vector_conversion as conversion
+
+
+def test_norm_logpdf_sum():
+    rng = np.random.default_rng(0)
+    x, mu = rng.standard_normal((2, 50, 20))
+    sd = rng.random((50, 20)) + 0.1
+    assert np.allclose(tcr_vae.norm_logpdf_sum(x, mu, sd), stats.norm.logpdf(x, mu, sd).sum(axis=1))
+    # We do the importance sampling in float32.
+    x, mu, sd = [a.astype(np.float32) for a in [x, mu, sd]]
+    assert np.allclose(tcr_vae.norm_logpdf_sum(x, mu, sd), stats.norm.logpdf(x, mu, sd).sum(axis=1), rtol=1e-5)
+
+
+# count_match is the riskier model, because its log p(x|z) works from the
+# germline-augmented CDR3 logits.
+@pytest.fixture(scope='module', params=['basic', 'count_match'])
+def vae_and_data(request):
+    params = tcr_vae.TCRVAE.default_params()
+    params['model'] = request.param
+    v = tcr_vae.TCRVAE(params)
+    df = pd.DataFrame({
+        'amino_acid': ['CASSLGQGYEQYF', 'CASSPGTGELFF', 'CSARDRTGNGYTF', 'CASSQDLNTEAFF', 'CATSDLGGNQPQHF'],
+        'v_gene': conversion.TCRB_V_GENE_LIST[:5],
+        'j_gene': conversion.TCRB_J_GENE_LIST[:5],
+    })
+    return v, conversion.unpadded_tcrbs_to_onehot(df, v.params['max_cdr3_len'])
+
+
+def per_sequence_log_pvae_importance_samples(v, x_df, nsamples, seed):
+    """
+    A straightforward version of log_pvae_importance_samples that goes one
+    sequence at a time and does everything in NumPy and scipy.
+    """
+    data = v.prepare_data(x_df)
+    z_mean, z_sd = v.encode_data(data)
+    obs = v.interpret_output(data)
+    n_seqs, latent_dim = z_mean.shape
+    # The noise is drawn sample-major: every sequence for the first sample,
+    # then every sequence for the second, and so on.
+    noise = np.random.default_rng(seed).standard_normal((nsamples, n_seqs, latent_dim), dtype=np.float32)
+    result = np.empty((nsamples, n_seqs))
+    for i in range(n_seqs):
+        z_sample = z_mean[i] + z_sd[i] * noise[:, i]
+        log_p_x_given_z = sum(
+            np.log((probs * o[i]).sum(axis=-1)).reshape(nsamples, -1).sum(axis=1)
+            for probs, o in zip(v.decode(z_sample), obs))
+        log_p_z = stats.norm.logpdf(z_sample).sum(axis=1)
+        log_q_z_given_x = stats.norm.logpdf(z_sample, z_mean[i], z_sd[i]).sum(axis=1)
+        result[:, i] = log_p_x_given_z + log_p_z - log_q_z_given_x
+    return result
+
+
+# With 5 sequences, these chunk sizes give one chunk, chunks of 2 samples with
+# a final chunk of 1, and one sample per chunk because n_seqs > chunk size.
+@pytest.mark.parametrize('chunk_size', [10000, 12, 3])
+def test_log_pvae_importance_samples(vae_and_data, monkeypatch, chunk_size):
+    v, x_df = vae_and_data
+    monkeypatch.setattr(tcr_vae, 'PREDICT_CHUNK_SIZE', chunk_size)
+    nsamples = 7
+    seed = 1
+    chunks = list(v.log_pvae_importance_samples(x_df, nsamples, seed=seed))
+    assert sum(len(chunk) for chunk in chunks) == nsamples
+    assert np.allclose(
+        np.concatenate(chunks), per_sequence_log_pvae_importance_samples(v, x_df, nsamples, seed), rtol=1e-4)
+
+
+def test_predict_in_chunks(vae_and_data):
+    v, x_df = vae_and_data
+    data = v.prepare_data(x_df)
+    # The encoder has multiple outputs.
+    for chunked, whole in zip(
+            tcr_vae.predict_in_chunks(v.encoder, data, chunk_size=2), v.encoder.predict_on_batch(data)):
+        assert np.allclose(chunked, whole)
+    # log_p_x_given_z has a single output.
+    z_mean, _ = v.encode_data(data)
+    log_p_x_given_z_inputs = [z_mean] + v.get_indices(data)
+    assert np.allclose(
+        tcr_vae.predict_in_chunks(v.log_p_x_given_z, log_p_x_given_z_inputs, chunk_size=2),
+        v.log_p_x_given_z.predict_on_batch(log_p_x_given_z_inputs))
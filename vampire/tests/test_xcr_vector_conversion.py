@@ -33,6 +33,9 @@ def test_cdr3_length_of_onehots():
     lengths = data['amino_acid'].apply(len).apply(float)
     onehots = conversion.unpadded_tcrbs_to_onehot(data, 30)
     assert lengths.equals(conversion.cdr3_length_of_onehots(onehots['amino_acid']))
+    # The stacked array version, as used by count_match.prepare_data.
+    cdr3_data, _, _ = common.cols_of_df(onehots)
+    assert np.array_equal(lengths.values, conversion.cdr3_length_of_onehots(cdr3_data))
 
 
 def test_contiguous_match_counts():
@@ -191,17 +191,20 @@ def adaptive_aa_encoding_tensors(max_cdr3_len):
                                            max_cdr3_len)
 
 
-def cdr3_length_of_onehots(onehot_cdr3s: pd.Series):
+def cdr3_length_of_onehots(onehot_cdr3s):
     """
     Compute the CDR3 length of one-hot-encoded CDR3s.
 
-    :param onehot_cdr3s: A Series of numpy one-hot-encoded arrays.
+    :param onehot_cdr3s: A Series of numpy one-hot-encoded arrays, or those
+        arrays already stacked into one of shape (n, max_cdr3_len, n_aas).
 
-    :return: a float array of CDR3 lengths.
+    :return: a float array of CDR3 lengths, as a Series if given a Series.
     """
-    # We assume that gap is the 21st amino acid.
-    all_but_gap_mask = np.array([AA_NONGAP]).transpose()
-    return onehot_cdr3s.apply(lambda row: np.sum(row.dot(all_but_gap_mask)))
+    if isinstance(onehot_cdr3s, pd.Series):
+        return pd.Series(
+            cdr3_length_of_onehots(np.stack(onehot_cdr3s)), index=onehot_cdr3s.index, name=onehot_cdr3s.name)
+    # AA_NONGAP is 1 for every amino acid except the gap.
+    return onehot_cdr3s.dot(AA_NONGAP).sum(axis=1)
 
 
 def contiguous_match_counts(padded_onehot, v_germline_aa_onehot, j_germline_aa_onehot):